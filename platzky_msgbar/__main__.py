@@ -0,0 +1,5 @@
+"""Allow running the msgbar build CLI with ``python -m platzky_msgbar``."""
+
+from platzky_msgbar.cli import main
+
+main(prog_name="platzky-msgbar")
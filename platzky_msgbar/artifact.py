@@ -0,0 +1,79 @@
+"""Prebuilt message bar artifacts, loadable without the render pipeline."""
+
+import hashlib
+import json
+from typing import Any, Dict, Mapping
+from platzky_msgbar.fileutil import atomic_write
+
+# Version of the artifact file format, bumped on incompatible payload changes
+ARTIFACT_FORMAT = 1
+
+
+def _payload_digest(payload: Mapping[str, Any]) -> str:
+    """Get the SHA-256 hex digest of the canonical JSON encoding of a payload."""
+    data = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def dump_artifact(payload: Mapping[str, Any]) -> str:
+    """
+    Serialize a rendered payload into an artifact.
+
+    Args:
+        payload: Rendered payload, as returned by ``render.build_payload``
+
+    Returns:
+        The artifact as a JSON document holding the format version, the payload
+        and its SHA-256 digest
+    """
+    artifact = {
+        "format": ARTIFACT_FORMAT,
+        "sha256": _payload_digest(payload),
+        "payload": payload,
+    }
+    return json.dumps(artifact, indent=2, sort_keys=True) + "\n"
+
+
+def parse_artifact(data: str) -> Dict[str, Any]:
+    """
+    Parse an artifact and verify its integrity.
+
+    Args:
+        data: Artifact JSON document
+
+    Returns:
+        The rendered payload
+
+    Raises:
+        ValueError: If the artifact is malformed, has an unsupported format or
+                    its digest does not match the payload
+    """
+    artifact = json.loads(data)
+    if not isinstance(artifact, dict) or not isinstance(artifact.get("payload"), dict):
+        raise ValueError("Invalid msgbar artifact: no payload")
+    if artifact.get("format") != ARTIFACT_FORMAT:
+        raise ValueError(
+            f"Unsupported msgbar artifact format {artifact.get('format')!r}, "
+            f"expected {ARTIFACT_FORMAT}"
+        )
+    payload = artifact["payload"]
+    if artifact.get("sha256") != _payload_digest(payload):
+        raise ValueError("Invalid msgbar artifact: sha256 does not match payload")
+    return payload
+
+
+def write_artifact(path: str, payload: Mapping[str, Any]) -> None:
+    """Atomically write a payload as an artifact file."""
+    atomic_write(path, dump_artifact(payload).encode(), prefix=".msgbar-artifact-")
+
+
+def load_artifact(path: str) -> Dict[str, Any]:
+    """
+    Load and verify an artifact file.
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If the artifact is invalid (see ``parse_artifact``)
+    """
+    with open(path, encoding="utf-8") as f:
+        return parse_artifact(f.read())
@@ -0,0 +1,161 @@
+"""
+Command line entry points of the msgbar plugin.
+
+The render pipeline (Pydantic config, Markdown, bleach) and the POSIX-only shared
+state are only imported by the commands that need them, so registering the
+commands stays cheap and portable.
+"""
+
+import json
+from typing import Any, Dict, Optional
+import click
+from flask.cli import AppGroup
+from platzky import Engine
+from platzky_msgbar.artifact import dump_artifact, load_artifact, write_artifact
+from platzky_msgbar.registry import MsgBarRegistry
+from platzky_msgbar.theme import get_theme
+
+
+def create_cli(app: Engine, registry: MsgBarRegistry) -> AppGroup:
+    """
+    Create the ``flask msgbar`` command group for the bars of an app.
+
+    Args:
+        app: The Flask Engine instance whose theme defaults are used
+        registry: Registry of the app's bars that commands publish to
+
+    Returns:
+        The command group, to be added to ``app.cli``
+    """
+    group = AppGroup("msgbar", help="Manage the message bar.")
+
+    @group.command("publish")
+    @click.argument("config_file", type=click.File("r"))
+    def publish(config_file):
+        """
+        Validate, render and publish a msgbar config to all workers.
+
+        CONFIG_FILE is a JSON file with the plugin config ("-" for stdin). It is
+        published to the bar with the same bar_id, which must use shared state.
+        """
+        from platzky_msgbar.config import MsgBarConfig
+        from platzky_msgbar.render import build_payload
+        from platzky_msgbar.shared import SharedBarState
+
+        config = MsgBarConfig(**json.load(config_file))
+        state = registry[config.bar_id] if config.bar_id in registry else None
+        if not isinstance(state, SharedBarState):
+            raise click.ClickException(
+                f"Bar {config.bar_id!r} does not use shared_state_path"
+            )
+        theme = get_theme(app)
+        version = state.publish(
+            build_payload(config, **theme), config_digest=config.get_digest(theme)
+        )
+        click.echo(f"Published message bar version {version} to {state.path}")
+
+    return group
+
+
+def _build_payload_from_file(
+    config_file,
+    primary_color: Optional[str],
+    secondary_color: Optional[str],
+    font: Optional[str],
+) -> Dict[str, Any]:
+    """Validate a JSON plugin config file and render it into a payload."""
+    from platzky_msgbar.config import MsgBarConfig
+    from platzky_msgbar.render import build_payload
+
+    try:
+        data = json.load(config_file)
+    except ValueError as e:
+        raise click.ClickException(f"Invalid msgbar config: {e}") from e
+    if not isinstance(data, dict):
+        raise click.ClickException("Invalid msgbar config: expected a JSON object")
+    # Artifacts only hold the rendered bar, the option would be silently dropped
+    if "shared_state_path" in data:
+        raise click.ClickException(
+            "Option shared_state_path cannot be used with artifacts; "
+            "set it in the plugin config instead of 'artifact'"
+        )
+    try:
+        return build_payload(
+            MsgBarConfig(**data),
+            primary_color=primary_color,
+            secondary_color=secondary_color,
+            font=font,
+        )
+    except ValueError as e:
+        raise click.ClickException(f"Invalid msgbar config: {e}") from e
+
+
+_theme_options = [
+    click.option("--primary-color", help="Theme primary color (background fallback)"),
+    click.option("--secondary-color", help="Theme secondary color (text fallback)"),
+    click.option("--font", help="Theme font (font-family fallback)"),
+]
+
+
+def _with_theme_options(command):
+    """Add the theme fallback options to a command."""
+    for option in reversed(_theme_options):
+        command = option(command)
+    return command
+
+
+@click.group(help="Build prerendered message bar artifacts.")
+def main():
+    """Entry point of the ``platzky-msgbar`` command."""
+
+
+@main.command("build")
+@click.argument("config_file", type=click.File("r"))
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Artifact file to write (defaults to stdout)",
+)
+@_with_theme_options
+def build(config_file, output, primary_color, secondary_color, font):
+    """
+    Validate and render a msgbar config into an artifact.
+
+    CONFIG_FILE is a JSON file with the plugin config ("-" for stdin). Load the
+    artifact with the plugin config {"artifact": "<path>"}.
+    """
+    payload = _build_payload_from_file(
+        config_file, primary_color, secondary_color, font
+    )
+    if output is None:
+        click.echo(dump_artifact(payload), nl=False)
+    else:
+        write_artifact(output, payload)
+        click.echo(f"Wrote message bar artifact to {output}", err=True)
+
+
+@main.command("check")
+@click.argument("config_file", type=click.File("r"))
+@click.argument("artifact_file", type=click.Path(exists=True, dir_okay=False))
+@_with_theme_options
+def check(config_file, artifact_file, primary_color, secondary_color, font):
+    """
+    Check that an artifact is valid and up to date with a msgbar config.
+
+    Exits with a non-zero status if the artifact is corrupted or differs from
+    what ``build`` would produce for CONFIG_FILE.
+    """
+    try:
+        artifact_payload = load_artifact(artifact_file)
+    except ValueError as e:
+        raise click.ClickException(str(e)) from e
+    payload = _build_payload_from_file(
+        config_file, primary_color, secondary_color, font
+    )
+    # Compare through JSON so that tuples and lists are treated alike
+    if json.loads(json.dumps(payload)) != artifact_payload:
+        raise click.ClickException(
+            f"{artifact_file} is out of date, rebuild it with 'platzky-msgbar build'"
+        )
+    click.echo(f"{artifact_file} is up to date")
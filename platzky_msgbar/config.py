@@ -1,11 +1,114 @@
 """Pydantic configuration model for msgbar plugin with CSS injection protection."""
 
+import hashlib
+import json
 import re
-from typing import Optional
-from pydantic import BaseModel, Field, field_validator
+from typing import Any, Dict, List, Mapping, Optional
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
 from pydantic_extra_types.color import Color
 
 
+class AudienceRule(BaseModel):
+    """
+    Targeting rule selecting which bar is shown to a request.
+
+    All conditions that are set must match (an empty rule matches every request).
+    Rules are evaluated in order and the first matching one wins.
+    """
+
+    # A misspelled condition must not silently widen the rule to every request
+    model_config = ConfigDict(extra="forbid")
+
+    logged_in: Optional[bool] = Field(
+        default=None,
+        description="Match only logged-in (True) or anonymous (False) visitors",
+    )
+
+    session_key: str = Field(
+        default="user",
+        description="Session key whose presence marks a visitor as logged in",
+    )
+
+    path_prefix: Optional[str] = Field(
+        default=None, description="Match request paths starting with this prefix"
+    )
+
+    cookie: Optional[str] = Field(
+        default=None, description="Match requests carrying this cookie"
+    )
+
+    cookie_pattern: Optional[str] = Field(
+        default=None, description="Regex searched for in the cookie value"
+    )
+
+    header: Optional[str] = Field(
+        default=None, description="Match requests carrying this header"
+    )
+
+    header_pattern: Optional[str] = Field(
+        default=None, description="Regex searched for in the header value"
+    )
+
+    rollout_percent: Optional[float] = Field(
+        default=None,
+        ge=0,
+        le=100,
+        description="Match this percentage of visitors, bucketed by a stable hash",
+    )
+
+    rollout_cookie: Optional[str] = Field(
+        default=None,
+        description="Cookie whose value is hashed for rollout (required for rollouts)",
+    )
+
+    rollout_salt: str = Field(
+        default="", description="Salt mixed into the rollout hash"
+    )
+
+    hide: bool = Field(default=False, description="Show no bar when this rule matches")
+
+    bar: Dict[str, Any] = Field(
+        default_factory=dict,
+        description="Overrides of the bar fields (message, colors...) for this audience",
+    )
+
+    @field_validator("cookie_pattern", "header_pattern")
+    @classmethod
+    def validate_pattern(cls, v: Optional[str]) -> Optional[str]:
+        """
+        Validate that patterns are valid regular expressions.
+
+        Unlike styling values, invalid patterns are rejected instead of ignored,
+        as dropping a condition would widen the audience of the rule.
+        """
+        if v is None:
+            return None
+
+        try:
+            re.compile(v)
+        except re.error as e:
+            raise ValueError(f"Invalid pattern {v!r}: {e}") from e
+
+        return v
+
+    @model_validator(mode="after")
+    def validate_pattern_targets(self) -> "AudienceRule":
+        """Ensure patterns and rollouts come with the cookie/header they apply to."""
+        if self.cookie_pattern is not None and self.cookie is None:
+            raise ValueError("cookie_pattern requires cookie")
+        if self.header_pattern is not None and self.header is None:
+            raise ValueError("header_pattern requires header")
+        # Client IPs are no stable visitor key (proxies, NAT), so rollouts
+        # are always bucketed by a cookie
+        if self.rollout_percent is not None and self.rollout_cookie is None:
+            raise ValueError("rollout_percent requires rollout_cookie")
+        return self
+
+    def get_conditions(self) -> Dict[str, Any]:
+        """Get the matching conditions of this rule as a plain dictionary."""
+        return self.model_dump(exclude={"hide", "bar"}, exclude_none=True)
+
+
 class MsgBarConfig(BaseModel):
     """
     Configuration model for the msgbar plugin.
@@ -17,6 +120,12 @@ class MsgBarConfig(BaseModel):
         description="The message to display in the bar (supports Markdown)",
     )
 
+    bar_id: str = Field(
+        default="MsgBar",
+        pattern=r"^[A-Za-z][A-Za-z0-9_-]{0,63}$",
+        description="HTML id of the bar; bars with different ids are stacked",
+    )
+
     background_color: Optional[str] = Field(
         default=None,
         description="CSS color value for background (hex, rgb/rgba, hsl/hsla, or color name)",
@@ -39,6 +148,16 @@ class MsgBarConfig(BaseModel):
         default=None, description="CSS height value (e.g., '30px', '2rem')"
     )
 
+    rules: List[AudienceRule] = Field(
+        default_factory=list,
+        description="Ordered targeting rules; requests matching none get this bar",
+    )
+
+    shared_state_path: Optional[str] = Field(
+        default=None,
+        description="Path of the state file shared between workers (enables shared mode)",
+    )
+
     @field_validator("background_color", "text_color")
     @classmethod
     def validate_color(cls, v: Optional[str]) -> Optional[str]:
@@ -134,3 +253,43 @@ class MsgBarConfig(BaseModel):
     def get_validated_bar_height(self, fallback: str = "30px") -> str:
         """Get validated bar height or fallback."""
         return self.bar_height or fallback
+
+    def for_rule(self, rule: AudienceRule) -> "MsgBarConfig":
+        """
+        Get the bar configuration for an audience rule.
+
+        Raises:
+            ValueError: If the rule's bar overrides unknown or non-bar fields
+            pydantic.ValidationError: If the rule's bar overrides are invalid
+        """
+        # A misspelled override would silently show the default bar instead
+        unknown = sorted(set(rule.bar) - _BAR_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown bar fields in rule: {', '.join(unknown)}")
+        fields = self.model_dump(
+            exclude={"rules", "shared_state_path"}, exclude_none=True
+        )
+        return MsgBarConfig(
+            **{**fields, **rule.bar, "rules": [], "bar_id": self.bar_id}
+        )
+
+    def get_digest(self, theme: Mapping[str, Optional[str]]) -> str:
+        """
+        Get a SHA-256 digest identifying the bar rendered from this config and theme.
+
+        The shared state path is left out, as it does not affect the rendered bar.
+        """
+        data = {
+            "config": self.model_dump(mode="json", exclude={"shared_state_path"}),
+            "theme": dict(theme),
+        }
+        encoded = json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+
+# Fields of a bar that audience rules can override
+_BAR_FIELDS = frozenset(MsgBarConfig.model_fields) - {
+    "bar_id",
+    "rules",
+    "shared_state_path",
+}
@@ -1,89 +1,65 @@
 """Platzky msgbar plugin entrypoint that injects a message bar into HTML responses."""
 
-from flask import Response
-from typing import Any, Dict
-import markdown
-import bleach
+import logging
+from flask import Response, g, request
+from markupsafe import escape
+from typing import Any, Dict, Optional
 from platzky import Engine
-from platzky_msgbar.config import MsgBarConfig
+from platzky_msgbar.artifact import load_artifact
+from platzky_msgbar.cli import create_cli
+from platzky_msgbar.fragment import MESSAGE_VAR_PREFIX, NONCE_SLOT, Fragment
+from platzky_msgbar.registry import MsgBarRegistry
+from platzky_msgbar.targeting import AudienceMatcher
+from platzky_msgbar.theme import get_theme
 
+logger = logging.getLogger(__name__)
 
-def process(app: Engine, plugin_config: Dict[str, Any]):
-    """
-    Process and inject a message bar into the Flask application.
 
-    This function configures the msgbar plugin by:
-    1. Validating the plugin configuration using Pydantic (prevents CSS injection)
-    2. Converting markdown message to HTML and sanitizing it (prevents XSS)
-    3. Retrieving theme defaults from the Platzky database
-    4. Registering an after_request hook to inject the message bar HTML/CSS
-
-    Args:
-        app: The Flask Engine instance to modify
-        plugin_config: Dictionary containing plugin configuration with required 'message'
-                      field and optional styling fields (background_color, text_color,
-                      font_family, font_size, bar_height)
-
-    Returns:
-        The modified Flask Engine instance with message bar functionality
-
-    Raises:
-        pydantic.ValidationError: If the plugin configuration is invalid
+def _get_csp_nonce() -> Optional[str]:
     """
-    # Validate and sanitize config using Pydantic model
-    # This protects against CSS injection attacks
-    config = MsgBarConfig(**plugin_config)
-
-    # Convert markdown to HTML (inline only, no <p> tags)
-    # attr_list extension allows syntax like: [link](url){:target="_blank"}
-    message_html = markdown.markdown(
-        config.message,
-        extensions=["extra", "attr_list"],
-        output_format="html",
-    ).strip()
-    # Remove wrapping <p> tags if present (for inline rendering)
-    if message_html.startswith("<p>") and message_html.endswith("</p>"):
-        message_html = message_html[3:-4]
-
-    # Sanitize HTML to prevent XSS attacks
-    # Allow only safe tags and attributes needed for message bar functionality
-    allowed_tags = ["a", "strong", "em", "b", "i", "code", "br", "span"]
-    allowed_attributes = {
-        "a": ["href", "title", "target", "rel"],
-        "span": ["class"],
-    }
-    # Sanitize and ensure no javascript: URLs or dangerous protocols
-    message = bleach.clean(
-        message_html,
-        tags=allowed_tags,
-        attributes=allowed_attributes,
-        protocols=["http", "https", "mailto"],
-        strip=True,
-    )
+    Return the CSP nonce of the current request, if any.
 
-    # Get Platzky defaults from database
-    # Will fail fast if db is not available
-    platzky_primary_color = app.db.get_primary_color()
-    platzky_secondary_color = app.db.get_secondary_color()
-    platzky_font = app.db.get_font()
+    The nonce is read from ``flask.g.csp_nonce`` or, as set by Flask-Talisman,
+    from ``flask.request.csp_nonce``.
+    """
+    return getattr(g, "csp_nonce", None) or getattr(request, "csp_nonce", None)
 
-    # Get validated CSS values with fallback priority:
-    # 1. Validated plugin config (from Pydantic model)
-    # 2. Platzky DB defaults
-    # 3. Hardcoded defaults
-    background_color = config.get_validated_background_color(
-        platzky_primary_color or "#245466"
-    )
 
-    text_color = config.get_validated_text_color(platzky_secondary_color or "white")
+def _get_slot_values(fragment: Fragment) -> Dict[str, bytes]:
+    """
+    Get the per-request slot values of a fragment.
 
-    font_family = config.get_validated_font_family(
-        f"'{platzky_font}', sans-serif" if platzky_font else "'Arial', sans-serif"
-    )
+    Fills in the CSP nonce and the ``{{ name }}`` message variables, taken from
+    the ``flask.g.msgbar_vars`` mapping and HTML-escaped.
+    """
+    values: Dict[str, bytes] = {}
+    nonce = _get_csp_nonce()
+    if nonce:
+        values[NONCE_SLOT] = f' nonce="{escape(nonce)}"'.encode()
+    context = None
+    for name in fragment.slot_names:
+        if name.startswith(MESSAGE_VAR_PREFIX):
+            if context is None:
+                context = getattr(g, "msgbar_vars", None) or {}
+            var = name[len(MESSAGE_VAR_PREFIX) :]
+            values[name] = str(escape(context.get(var, ""))).encode()
+    return values
+
+
+def _get_registry(app: Engine) -> MsgBarRegistry:
+    """
+    Get the bar registry of an app, setting it up on first use.
 
-    font_size = config.get_validated_font_size("14px")
+    The registry is stored as ``app.extensions["msgbar"]``. Setting it up
+    registers the ``flask msgbar`` commands and the single after_request hook
+    that injects all registered bars.
+    """
+    registry = app.extensions.get("msgbar")
+    if registry is not None:
+        return registry
 
-    bar_height = config.get_validated_bar_height("30px")
+    registry = app.extensions["msgbar"] = MsgBarRegistry()
+    app.cli.add_command(create_cli(app, registry))
 
     @app.after_request
     def inject_msg_bar(response: Response) -> Response:
@@ -91,7 +67,8 @@ def process(app: Engine, plugin_config: Dict[str, Any]):
         Inject message bar HTML and CSS into HTML responses.
 
         This Flask after_request hook intercepts HTML responses and injects
-        the message bar styles and HTML before the closing </head> tag.
+        the message bar styles and HTML before the closing </head> tag. The
+        headers and cookies read by audience rules are added to ``Vary``.
 
         Args:
             response: The Flask Response object to modify
@@ -101,69 +78,129 @@ def process(app: Engine, plugin_config: Dict[str, Any]):
             or the original response unchanged (if not HTML)
         """
         if "text/html" in response.headers.get("Content-Type", ""):
-            bar_html = f"""
-<style id="MsgBarStyle">
-
-#MsgBar {{
-    position: fixed;
-    top: 0;
-    left: 0;
-    width: 100%;
-    background-color: {background_color};
-    color: {text_color};
-    font-size: {font_size};
-    font-family: {font_family};
-    z-index: 9999;
-    box-shadow: 0 1px 3px rgba(0,0,0,0.2);
-
-    display: flex;
-    align-items: center;
-    justify-content: center;
-    padding: 5px 10px;
-}}
-
-#MsgBar .msg-content {{
-    flex: 1;             /* takes full width */
-    text-align: center;  /* centers the text */
-}}
-
-#MsgBar .msg-content a {{
-    color: inherit;
-    text-decoration: underline;
-    font-weight: bold;
-}}
-
-#MsgBar .msg-content a:hover {{
-    text-decoration: none;
-    opacity: 0.8;
-}}
-
-#MsgBar .close-btn {{
-    position: relative;  /* required by tests */
-    margin-left: auto;   /* pushes to the right */
-    font-weight: bold;
-    font-size: 16px;
-    color: {text_color};
-    cursor: pointer;
-    background: none;
-    border: none;
-}}
-
-body {{
-    padding-top: {bar_height} !important;
-}}
-
-</style>
-<div id="MsgBar">
-    <div class="msg-content">{message}</div>
-    <button class="close-btn" onclick="document.getElementById('MsgBar').remove();document.getElementById('MsgBarStyle').remove();">&times;</button>
-</div>
-"""
-
-            html = response.get_data(as_text=True)
-            html = html.replace("</head>", bar_html + "</head>")
-            response.set_data(html)
+            fragment, vary = registry.select(request)
+            # Caches must not serve one audience's bar to another
+            for header in vary:
+                response.vary.add(header)
+            if fragment is not None:
+                bar_html = fragment.render(_get_slot_values(fragment))
+                body = response.get_data()
+                response.set_data(body.replace(b"</head>", bar_html + b"</head>"))
 
         return response
 
+    return registry
+
+
+def _process_artifact(app: Engine, plugin_config: Dict[str, Any]):
+    """
+    Register the bar of a prebuilt artifact.
+
+    Raises:
+        ValueError: If other options are given or the artifact is invalid
+    """
+    other_keys = sorted(set(plugin_config) - {"artifact"})
+    if other_keys:
+        raise ValueError(
+            f"Options {', '.join(other_keys)} cannot be used with 'artifact'; "
+            "set them when building the artifact instead"
+        )
+
+    source = AudienceMatcher.from_payload(load_artifact(plugin_config["artifact"]))
+    _get_registry(app).register(source.bar_id, source)
+    return app
+
+
+def process(app: Engine, plugin_config: Dict[str, Any]):
+    """
+    Process and inject a message bar into the Flask application.
+
+    This function configures the msgbar plugin by:
+    1. Validating the plugin configuration using Pydantic (prevents CSS injection)
+    2. Converting markdown message to HTML and sanitizing it (prevents XSS)
+    3. Retrieving theme defaults from the Platzky database
+    4. Prerendering the bar, and the bar of every audience rule, into fragments
+       of constant byte segments
+    5. Compiling the audience rules into a matcher
+    6. Registering the matcher under the bar's ``bar_id`` in the app's bar
+       registry (``app.extensions["msgbar"]``), which injects the HTML/CSS of
+       all bars with a single after_request hook
+
+    Calling this again with the same ``bar_id`` replaces that bar; a different
+    ``bar_id`` stacks a new bar below the existing ones. Per request the bars
+    are picked by their matchers, stacked into a cached composite fragment and
+    only its slots are filled in (see ``_get_slot_values``).
+
+    With ``shared_state_path`` set, the rendered bar is read from a state file
+    shared by all workers instead (see ``SharedBarState``). The file is seeded
+    with this config if it does not exist yet or has an incompatible format,
+    and can be updated at runtime with ``flask msgbar publish CONFIG_FILE``.
+    Otherwise the config is not rendered; if it differs from the published
+    one, a warning is logged.
+
+    With ``artifact`` set (as the only key), the bar is loaded from an artifact
+    prebuilt by ``platzky-msgbar build``. Validation, rendering and the theme
+    lookup are skipped, and the render pipeline is never imported.
+
+    Args:
+        app: The Flask Engine instance to modify
+        plugin_config: Dictionary containing plugin configuration with required 'message'
+                      field and optional styling fields (background_color, text_color,
+                      font_family, font_size, bar_height, bar_id, rules,
+                      shared_state_path), or only an 'artifact' path
+
+    Returns:
+        The modified Flask Engine instance with message bar functionality
+
+    Raises:
+        pydantic.ValidationError: If the plugin configuration is invalid
+        ValueError: If the artifact is invalid
+    """
+    if "artifact" in plugin_config:
+        return _process_artifact(app, plugin_config)
+
+    # Imported here so that apps using prebuilt artifacts never load the
+    # render pipeline (Pydantic config model, Markdown, bleach)
+    from platzky_msgbar.config import MsgBarConfig
+    from platzky_msgbar.render import build_payload
+
+    # Validate and sanitize config using Pydantic model
+    # This protects against CSS injection attacks
+    config = MsgBarConfig(**plugin_config)
+
+    # Get Platzky defaults from database
+    # Will fail fast if db is not available
+    theme = get_theme(app)
+
+    if config.shared_state_path:
+        # Imported here as it needs POSIX-only modules (fcntl)
+        from platzky_msgbar.shared import SharedBarState
+
+        # Shared mode: serve whatever was last published to the state file,
+        # seeding it with this config on first start or when the file was
+        # written in a format this version cannot read
+        source = SharedBarState(config.shared_state_path)
+        digest = config.get_digest(theme)
+        if not source.is_compatible():
+            if source.exists():
+                logger.warning(
+                    "Message bar state %s is unreadable or has an old format, "
+                    "replacing it with the plugin config",
+                    source.path,
+                )
+            source.publish(build_payload(config, **theme), config_digest=digest)
+        elif source.get_config_digest() != digest:
+            logger.warning(
+                "Plugin config of message bar %r differs from the bar published "
+                "in %s; serving the published bar. Run 'flask msgbar publish' "
+                "to apply the config",
+                config.bar_id,
+                source.path,
+            )
+    else:
+        source = AudienceMatcher.from_payload(build_payload(config, **theme))
+
+    registry = _get_registry(app)
+    registry.register(config.bar_id, source)
+
     return app
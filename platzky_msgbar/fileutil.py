@@ -0,0 +1,32 @@
+"""File helpers shared by the artifact and shared state writers."""
+
+import os
+import tempfile
+
+
+def atomic_write(path: str, data: bytes, prefix: str = ".msgbar-") -> None:
+    """
+    Atomically replace a file with the given data.
+
+    The data is written and synced to a unique temporary file in the same
+    directory, which then replaces ``path``, so readers see either the old or
+    the new file, never a partial one. The temporary file is removed if any
+    step fails.
+
+    Args:
+        path: Path of the file to replace
+        data: New contents of the file
+        prefix: Prefix of the temporary file name
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,202 @@
+"""Prerendered message bar fragment split into constant byte segments and named slots."""
+
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+# Slot holding the ` nonce="..."` attribute for the inline <style> and <script>
+NONCE_SLOT = "nonce"
+
+# Slots holding the CSS offset of a bar and the body padding, set when stacking bars
+TOP_SLOT = "top"
+PADDING_TOP_SLOT = "padding_top"
+
+# Slot holding the CSS that fixes the height of a bar, set only for stacked bars
+HEIGHT_SLOT = "height"
+
+# Prefix of slots created from {{ name }} placeholders in the message
+MESSAGE_VAR_PREFIX = "var:"
+
+
+class Slot:
+    """
+    Named placeholder inside a fragment, filled in per request.
+
+    Attributes:
+        name: Name of the value that will be substituted for this slot
+    """
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self) -> str:
+        return f"Slot({self.name!r})"
+
+
+class Fragment:
+    """
+    Immutable HTML fragment stored as encoded segments with named slots between them.
+
+    All constant text is encoded to bytes once, at construction time. Rendering a
+    fragment only drops the per-request slot values into a prebuilt list and does
+    a single ``b"".join``, so values like a CSP nonce cost next to nothing.
+
+    Slot values are inserted verbatim - callers are responsible for escaping them
+    for the context the slot appears in.
+    """
+
+    __slots__ = ("_segments", "_slots")
+
+    def __init__(self, parts: Sequence[Union[str, bytes, Slot]]):
+        """
+        Build a fragment from a sequence of text parts and slots.
+
+        Adjacent text parts are merged, so the resulting fragment always
+        alternates between constant segments and slots.
+
+        Args:
+            parts: Strings (UTF-8 encoded), bytes and Slot placeholders in output order
+        """
+        segments: List[bytes] = []
+        slots: List[Tuple[int, str]] = []
+        pending = b""
+        for part in parts:
+            if isinstance(part, Slot):
+                segments.append(pending)
+                slots.append((len(segments), part.name))
+                segments.append(b"")
+                pending = b""
+            else:
+                pending += part.encode() if isinstance(part, str) else part
+        segments.append(pending)
+        self._segments = tuple(segments)
+        self._slots = tuple(slots)
+
+    @property
+    def slot_names(self) -> Tuple[str, ...]:
+        """Names of the slots in this fragment, in output order."""
+        return tuple(name for _, name in self._slots)
+
+    def render(self, values: Mapping[str, bytes]) -> bytes:
+        """
+        Render the fragment with the given slot values.
+
+        Args:
+            values: Mapping of slot name to already escaped bytes; missing slots render empty
+
+        Returns:
+            The complete fragment as bytes
+        """
+        if not self._slots:
+            return self._segments[0]
+        parts = list(self._segments)
+        for index, name in self._slots:
+            parts[index] = values.get(name, b"")
+        return b"".join(parts)
+
+    def _parts(self) -> List[Union[bytes, Slot]]:
+        """Get the fragment as byte segments and slots (empty segments skipped)."""
+        slot_at = dict(self._slots)
+        parts: List[Union[bytes, Slot]] = []
+        for index, segment in enumerate(self._segments):
+            if index in slot_at:
+                parts.append(Slot(slot_at[index]))
+            elif segment:
+                parts.append(segment)
+        return parts
+
+    def bind(self, values: Mapping[str, bytes]) -> "Fragment":
+        """
+        Fill in some of the slots ahead of time.
+
+        Args:
+            values: Mapping of slot name to already escaped bytes
+
+        Returns:
+            New fragment with the given slots replaced by constant segments
+        """
+        return Fragment(
+            [
+                (
+                    values[part.name]
+                    if isinstance(part, Slot) and part.name in values
+                    else part
+                )
+                for part in self._parts()
+            ]
+        )
+
+    @classmethod
+    def concat(cls, fragments: Iterable["Fragment"]) -> "Fragment":
+        """Join fragments into a single fragment, keeping their slots."""
+        return cls([part for fragment in fragments for part in fragment._parts()])
+
+    def to_json(self) -> List[Union[str, Dict[str, str]]]:
+        """
+        Serialize the fragment to a JSON-compatible list.
+
+        Returns:
+            Text segments as strings and slots as ``{"slot": name}`` objects
+        """
+        return [
+            {"slot": part.name} if isinstance(part, Slot) else part.decode()
+            for part in self._parts()
+        ]
+
+    @classmethod
+    def from_json(cls, data: Sequence[Any]) -> "Fragment":
+        """
+        Deserialize a fragment produced by ``to_json``.
+
+        Raises:
+            ValueError: If the data is not a serialized fragment
+        """
+        parts: List[Union[str, Slot]] = []
+        for part in data:
+            if isinstance(part, str):
+                parts.append(part)
+            elif isinstance(part, dict) and isinstance(part.get("slot"), str):
+                parts.append(Slot(part["slot"]))
+            else:
+                raise ValueError(f"Invalid fragment part: {part!r}")
+        return cls(parts)
+
+
+class RenderedBar(NamedTuple):
+    """
+    Prerendered message bar with the layout information needed to stack it.
+
+    Attributes:
+        fragment: The bar fragment, with ``top``, ``height`` and ``padding_top`` slots
+        height: CSS height of the bar, used to offset the bars below it
+    """
+
+    fragment: Fragment
+    height: str
+
+    def to_json(self) -> Dict[str, Any]:
+        """Serialize the bar to a JSON-compatible dictionary."""
+        return {"fragment": self.fragment.to_json(), "height": self.height}
+
+    @classmethod
+    def from_json(cls, data: Mapping[str, Any]) -> "RenderedBar":
+        """
+        Deserialize a bar produced by ``to_json``.
+
+        Raises:
+            ValueError: If the data is not a serialized bar
+        """
+        try:
+            return cls(Fragment.from_json(data["fragment"]), str(data["height"]))
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid rendered bar: {e}") from e
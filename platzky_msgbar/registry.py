@@ -0,0 +1,146 @@
+"""Registry of the message bars of an app, composed and injected in a single pass."""
+
+from typing import Dict, Iterator, Optional, Protocol, Sequence, Set, Tuple
+from flask import Request
+from platzky_msgbar.fragment import (
+    HEIGHT_SLOT,
+    PADDING_TOP_SLOT,
+    TOP_SLOT,
+    Fragment,
+    RenderedBar,
+)
+from platzky_msgbar.targeting import AudienceMatcher
+
+# Number of composite fragments cached before the cache is reset
+COMPOSITE_CACHE_SIZE = 64
+
+
+class BarSource(Protocol):
+    """Source of the matcher picking the prerendered bar for a request."""
+
+    @property
+    def matcher(self) -> Optional[AudienceMatcher]:
+        """Current matcher, or None if no bar is available."""
+        ...
+
+
+def _stack_offset(heights: Sequence[str]) -> str:
+    """Get the CSS offset below bars of the given heights."""
+    if not heights:
+        return "0"
+    if len(heights) == 1:
+        return heights[0]
+    return f"calc({' + '.join(heights)})"
+
+
+def _fixed_height(height: str) -> str:
+    """Get the CSS declarations making a bar exactly as tall as its stack offset."""
+    return f"""    height: {height};
+    box-sizing: border-box;
+    overflow: hidden;
+"""
+
+
+def compose(bars: Sequence[RenderedBar]) -> Fragment:
+    """
+    Stack bars into one composite fragment.
+
+    Each bar is placed below the previous ones and sets the body padding to
+    the total height of the stack so far, so the last bar's padding wins.
+    Stacked bars get a fixed height so that they line up with the offsets;
+    a single bar grows with its message instead.
+
+    Args:
+        bars: Bars in stacking order, top first
+
+    Returns:
+        Fragment of all bars, keeping their per-request slots
+    """
+    stacked = len(bars) > 1
+    fragments = []
+    heights = []
+    for bar in bars:
+        top = _stack_offset(heights)
+        heights.append(bar.height)
+        fragments.append(
+            bar.fragment.bind(
+                {
+                    TOP_SLOT: top.encode(),
+                    HEIGHT_SLOT: _fixed_height(bar.height).encode() if stacked else b"",
+                    PADDING_TOP_SLOT: _stack_offset(heights).encode(),
+                }
+            )
+        )
+    return Fragment.concat(fragments)
+
+
+class MsgBarRegistry:
+    """
+    Message bars registered on an app, keyed by bar id, in stacking order.
+
+    Registering a bar under an existing id replaces it. For each request the
+    bars selected by every source are stacked into a composite fragment, which
+    is cached per combination of selected bars.
+    """
+
+    def __init__(self):
+        self._sources: Dict[str, BarSource] = {}
+        self._composites: Dict[Tuple[RenderedBar, ...], Fragment] = {}
+
+    def __getitem__(self, bar_id: str) -> BarSource:
+        return self._sources[bar_id]
+
+    def __contains__(self, bar_id: object) -> bool:
+        return bar_id in self._sources
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._sources)
+
+    def __len__(self) -> int:
+        return len(self._sources)
+
+    def register(self, bar_id: str, source: BarSource) -> None:
+        """
+        Add a bar, or replace the bar registered under the same id.
+
+        Args:
+            bar_id: HTML id of the bar
+            source: Source selecting the prerendered bar per request
+        """
+        self._sources[bar_id] = source
+        self._composites.clear()
+
+    def select(self, request: Request) -> Tuple[Optional[Fragment], Set[str]]:
+        """
+        Select the composite fragment of all bars to show for a request.
+
+        Each source's matcher is resolved once, so the bars and the headers
+        they depend on always come from the same version of every source.
+
+        Args:
+            request: The current Flask request
+
+        Returns:
+            The composite fragment (None if no bar should be shown) and the
+            request headers that the selection depends on
+        """
+        selected = []
+        vary: Set[str] = set()
+        for source in self._sources.values():
+            matcher = source.matcher
+            if matcher is None:
+                continue
+            vary.update(matcher.vary)
+            bar = matcher.select(request)
+            if bar is not None:
+                selected.append(bar)
+        if not selected:
+            return None, vary
+
+        key = tuple(selected)
+        composite = self._composites.get(key)
+        if composite is None:
+            if len(self._composites) >= COMPOSITE_CACHE_SIZE:
+                self._composites.clear()
+            composite = self._composites[key] = compose(selected)
+        return composite, vary
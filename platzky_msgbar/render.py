@@ -0,0 +1,264 @@
+"""Rendering of a validated msgbar configuration into prerendered fragments."""
+
+import re
+from typing import Any, Dict, List, Optional, Union
+import markdown
+import bleach
+from platzky_msgbar.config import MsgBarConfig
+from platzky_msgbar.fragment import (
+    HEIGHT_SLOT,
+    MESSAGE_VAR_PREFIX,
+    NONCE_SLOT,
+    PADDING_TOP_SLOT,
+    TOP_SLOT,
+    Fragment,
+    RenderedBar,
+    Slot,
+)
+
+_MESSAGE_VAR_PATTERN = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+# HTML tag, including quoted attribute values that may contain ">"
+_TAG_PATTERN = re.compile(r"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+
+
+def render_message(message: str) -> str:
+    """
+    Convert a Markdown message to sanitized inline HTML.
+
+    Args:
+        message: Message text in Markdown
+
+    Returns:
+        HTML safe to embed in the message bar (no wrapping <p> tag)
+    """
+    # Convert markdown to HTML (inline only, no <p> tags)
+    # attr_list extension allows syntax like: [link](url){:target="_blank"}
+    message_html = markdown.markdown(
+        message,
+        extensions=["extra", "attr_list"],
+        output_format="html",
+    ).strip()
+    # Remove wrapping <p> tags if present (for inline rendering)
+    if message_html.startswith("<p>") and message_html.endswith("</p>"):
+        message_html = message_html[3:-4]
+
+    # Sanitize HTML to prevent XSS attacks
+    # Allow only safe tags and attributes needed for message bar functionality
+    allowed_tags = ["a", "strong", "em", "b", "i", "code", "br", "span"]
+    allowed_attributes = {
+        "a": ["href", "title", "target", "rel"],
+        "span": ["class"],
+    }
+    # Sanitize and ensure no javascript: URLs or dangerous protocols
+    return bleach.clean(
+        message_html,
+        tags=allowed_tags,
+        attributes=allowed_attributes,
+        protocols=["http", "https", "mailto"],
+        strip=True,
+    )
+
+
+def _message_parts(message_html: str) -> List[Union[str, Slot]]:
+    """
+    Split sanitized message HTML on {{ name }} placeholders into text and slots.
+
+    Placeholders are only allowed in text: their values are filled in after
+    sanitization and only HTML-escaped, which is not enough inside attributes
+    (e.g. a ``javascript:`` URL in a link href).
+
+    Raises:
+        ValueError: If a placeholder appears inside a tag
+    """
+    parts: List[Union[str, Slot]] = []
+    position = 0
+    for tag in _TAG_PATTERN.finditer(message_html):
+        if _MESSAGE_VAR_PATTERN.search(tag.group(0)):
+            raise ValueError(
+                f"Message placeholders are only allowed in text, not in {tag.group(0)}"
+            )
+    for match in _MESSAGE_VAR_PATTERN.finditer(message_html):
+        parts.append(message_html[position : match.start()])
+        parts.append(Slot(MESSAGE_VAR_PREFIX + match.group(1)))
+        position = match.end()
+    parts.append(message_html[position:])
+    return parts
+
+
+def build_bar(
+    config: MsgBarConfig,
+    primary_color: Optional[str] = None,
+    secondary_color: Optional[str] = None,
+    font: Optional[str] = None,
+) -> RenderedBar:
+    """
+    Render the message bar HTML/CSS for a configuration into a fragment.
+
+    The fragment has a ``nonce`` slot on the inline <style> and <script> tags,
+    ``top``, ``height`` and ``padding_top`` slots for its position in the stack
+    of bars and
+    one ``var:<name>`` slot per ``{{ name }}`` placeholder in the message.
+
+    Args:
+        config: Validated plugin configuration
+        primary_color: Platzky theme primary color (background fallback)
+        secondary_color: Platzky theme secondary color (text fallback)
+        font: Platzky theme font (font-family fallback)
+
+    Returns:
+        The prerendered message bar
+    """
+    bar_id = config.bar_id
+    message_parts = _message_parts(render_message(config.message))
+
+    # Get validated CSS values with fallback priority:
+    # 1. Validated plugin config (from Pydantic model)
+    # 2. Platzky DB defaults
+    # 3. Hardcoded defaults
+    background_color = config.get_validated_background_color(primary_color or "#245466")
+
+    text_color = config.get_validated_text_color(secondary_color or "white")
+
+    font_family = config.get_validated_font_family(
+        f"'{font}', sans-serif" if font else "'Arial', sans-serif"
+    )
+
+    font_size = config.get_validated_font_size("14px")
+
+    bar_height = config.get_validated_bar_height("30px")
+
+    fragment = Fragment(
+        [
+            f'\n<style id="{bar_id}Style"',
+            Slot(NONCE_SLOT),
+            f""">
+
+#{bar_id} {{
+    position: fixed;
+    top: """,
+            Slot(TOP_SLOT),
+            """;
+    left: 0;
+    width: 100%;
+""",
+            Slot(HEIGHT_SLOT),
+            f"""    background-color: {background_color};
+    color: {text_color};
+    font-size: {font_size};
+    font-family: {font_family};
+    z-index: 9999;
+    box-shadow: 0 1px 3px rgba(0,0,0,0.2);
+
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    padding: 5px 10px;
+}}
+
+#{bar_id} .msg-content {{
+    flex: 1;             /* takes full width */
+    text-align: center;  /* centers the text */
+}}
+
+#{bar_id} .msg-content a {{
+    color: inherit;
+    text-decoration: underline;
+    font-weight: bold;
+}}
+
+#{bar_id} .msg-content a:hover {{
+    text-decoration: none;
+    opacity: 0.8;
+}}
+
+#{bar_id} .close-btn {{
+    position: relative;  /* required by tests */
+    margin-left: auto;   /* pushes to the right */
+    font-weight: bold;
+    font-size: 16px;
+    color: {text_color};
+    cursor: pointer;
+    background: none;
+    border: none;
+}}
+
+body {{
+    padding-top: """,
+            Slot(PADDING_TOP_SLOT),
+            f""" !important;
+}}
+
+</style>
+<div id="{bar_id}" data-msgbar>
+    <div class="msg-content">""",
+            *message_parts,
+            """</div>
+    <button class="close-btn" type="button">&times;</button>
+</div>
+<script""",
+            Slot(NONCE_SLOT),
+            f""">
+document.querySelector('#{bar_id} .close-btn').addEventListener('click', function () {{
+    document.getElementById('{bar_id}').remove();
+    document.getElementById('{bar_id}Style').remove();
+    // Move the remaining bars up and shrink the body padding to match
+    var top = 0;
+    document.querySelectorAll('[data-msgbar]').forEach(function (bar) {{
+        bar.style.top = top + 'px';
+        top += bar.offsetHeight;
+    }});
+    if (top) {{
+        document.body.style.setProperty('padding-top', top + 'px', 'important');
+    }} else {{
+        document.body.style.removeProperty('padding-top');
+    }}
+}});
+</script>
+""",
+        ]
+    )
+    return RenderedBar(fragment, bar_height)
+
+
+def build_payload(
+    config: MsgBarConfig,
+    primary_color: Optional[str] = None,
+    secondary_color: Optional[str] = None,
+    font: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Render a configuration, including its audience rules, into a JSON-compatible payload.
+
+    The payload holds everything needed to serve the bar without the render
+    pipeline; load it with ``AudienceMatcher.from_payload``.
+
+    Args:
+        config: Validated plugin configuration
+        primary_color: Platzky theme primary color (background fallback)
+        secondary_color: Platzky theme secondary color (text fallback)
+        font: Platzky theme font (font-family fallback)
+
+    Returns:
+        Dictionary with the bar id, the serialized default bar and the ordered rules
+    """
+    theme = {
+        "primary_color": primary_color,
+        "secondary_color": secondary_color,
+        "font": font,
+    }
+    return {
+        "bar_id": config.bar_id,
+        "default": build_bar(config, **theme).to_json(),
+        "rules": [
+            {
+                "conditions": rule.get_conditions(),
+                "bar": (
+                    None
+                    if rule.hide
+                    else build_bar(config.for_rule(rule), **theme).to_json()
+                ),
+            }
+            for rule in config.rules
+        ],
+    }
@@ -0,0 +1,170 @@
+"""Message bar state shared between worker processes through memory-mapped files."""
+
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Any, Dict, Mapping, Optional
+from platzky_msgbar.fileutil import atomic_write
+from platzky_msgbar.targeting import AudienceMatcher, TargetingMetrics
+
+logger = logging.getLogger(__name__)
+
+# Version of the state file format, bumped on incompatible payload changes
+STATE_FORMAT = 1
+
+_VERSION_FORMAT = "<Q"
+_VERSION_SIZE = struct.calcsize(_VERSION_FORMAT)
+
+
+class SharedBarState:
+    """
+    Rendered message bar shared by all workers of a deployment.
+
+    The state lives in two files: ``path`` holds the rendered payload (see
+    ``render.build_payload``) as JSON, tagged with ``STATE_FORMAT``, and ``path + ".version"`` holds a 64-bit
+    counter that is bumped on every publish. Each worker keeps the counter file
+    memory-mapped, so checking for updates costs a single read per request; the
+    payload file is only memory-mapped and parsed again when the counter changes.
+
+    Publishing writes the payload to a temporary file that atomically replaces
+    ``path`` before the counter is bumped, so readers never see a partial payload.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open the shared state, creating the version file if needed.
+
+        Args:
+            path: Path of the payload file; the version file is placed next to it
+        """
+        self.path = path
+        self.version_path = path + ".version"
+        self._version = -1
+        self._matcher: Optional[AudienceMatcher] = None
+
+        fd = os.open(self.version_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _VERSION_SIZE:
+                os.ftruncate(fd, _VERSION_SIZE)
+            self._version_map = mmap.mmap(fd, _VERSION_SIZE)
+        finally:
+            os.close(fd)
+
+    @property
+    def version(self) -> int:
+        """Current published version (0 if nothing was published yet)."""
+        return struct.unpack_from(_VERSION_FORMAT, self._version_map)[0]
+
+    def exists(self) -> bool:
+        """Check whether a payload was published."""
+        return os.path.exists(self.path)
+
+    def publish(
+        self, payload: Mapping[str, Any], config_digest: Optional[str] = None
+    ) -> int:
+        """
+        Atomically replace the shared payload and notify all workers.
+
+        Args:
+            payload: Rendered payload, as returned by ``render.build_payload``
+            config_digest: Digest of the config the payload was rendered from
+                           (see ``MsgBarConfig.get_digest``)
+
+        Returns:
+            The new version number
+        """
+        state = {
+            "format": STATE_FORMAT,
+            "config_sha256": config_digest,
+            "payload": payload,
+        }
+        data = json.dumps(state, separators=(",", ":")).encode()
+        with open(self.version_path, "rb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                atomic_write(self.path, data)
+                version = self.version + 1
+                struct.pack_into(_VERSION_FORMAT, self._version_map, 0, version)
+                self._version_map.flush()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return version
+
+    def _read(self) -> Dict[str, Any]:
+        """
+        Memory-map the state file and parse it.
+
+        Raises:
+            OSError: If the state file cannot be read
+            ValueError: If the state file is malformed or has another format
+        """
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                state = json.loads(data[:])
+        if not isinstance(state, dict) or state.get("format") != STATE_FORMAT:
+            found = state.get("format") if isinstance(state, dict) else None
+            raise ValueError(
+                f"Unsupported message bar state format {found!r}, "
+                f"expected {STATE_FORMAT}"
+            )
+        return state
+
+    def is_compatible(self) -> bool:
+        """Check whether the state file exists and can be read by this version."""
+        try:
+            self._read()
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def get_config_digest(self) -> Optional[str]:
+        """
+        Get the digest of the config the published payload was rendered from.
+
+        Raises:
+            OSError: If the state file cannot be read
+            ValueError: If the state file is malformed or has another format
+        """
+        return self._read().get("config_sha256")
+
+    def _load(self) -> AudienceMatcher:
+        """
+        Build a matcher from the payload of the state file.
+
+        Raises:
+            OSError: If the state file cannot be read
+            ValueError: If the state file or its payload is malformed
+        """
+        return AudienceMatcher.from_payload(self._read().get("payload"))
+
+    @property
+    def matcher(self) -> Optional[AudienceMatcher]:
+        """
+        Matcher for the latest published payload, reloaded when the version changes.
+
+        If a published payload cannot be loaded, the error is logged and the last
+        good matcher is kept; that version is not retried until the next publish.
+        Returns None if no payload could be loaded yet.
+        """
+        version = self.version
+        if version != self._version:
+            self._version = version
+            try:
+                self._matcher = self._load()
+            except (OSError, ValueError):
+                logger.exception(
+                    "Could not load message bar state %s (version %d), "
+                    "keeping the previous bar",
+                    self.path,
+                    version,
+                )
+        return self._matcher
+
+    @property
+    def metrics(self) -> TargetingMetrics:
+        """Rule evaluation metrics of the current payload (reset on every update)."""
+        matcher = self.matcher
+        return matcher.metrics if matcher is not None else TargetingMetrics(0)
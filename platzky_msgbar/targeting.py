@@ -0,0 +1,256 @@
+"""Audience targeting rules compiled into an ordered per-request matcher."""
+
+import re
+import time
+import zlib
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from flask import Request, session
+from platzky_msgbar.fragment import RenderedBar
+
+Predicate = Callable[[Request], bool]
+
+# Rollout buckets, giving a 0.01% granularity for rollout_percent
+ROLLOUT_BUCKETS = 10000
+
+
+def rollout_bucket(key: str, salt: str = "") -> int:
+    """
+    Get the stable rollout bucket of a visitor key.
+
+    Args:
+        key: Visitor key (value of the rollout cookie)
+        salt: Salt of the rule, so that rollouts of different rules are independent
+
+    Returns:
+        Bucket number in range [0, ROLLOUT_BUCKETS)
+    """
+    return zlib.crc32(f"{salt}:{key}".encode()) % ROLLOUT_BUCKETS
+
+
+def _value_predicate(
+    getter: Callable[[Request], Optional[str]], pattern: Optional[str]
+) -> Predicate:
+    """Build a predicate checking a request value is present and matches pattern."""
+    if pattern is None:
+        return lambda request: getter(request) is not None
+
+    search = re.compile(pattern).search
+
+    def matches(request: Request) -> bool:
+        value = getter(request)
+        return value is not None and search(value) is not None
+
+    return matches
+
+
+def get_vary_headers(conditions: Mapping[str, Any]) -> Set[str]:
+    """
+    Get the request headers that rule conditions read, for the Vary header.
+
+    Args:
+        conditions: Conditions as returned by AudienceRule.get_conditions
+
+    Returns:
+        Names of the headers the bar selected by the rule depends on
+    """
+    headers = set()
+    if conditions.get("header") is not None:
+        headers.add(conditions["header"])
+    if (
+        conditions.get("cookie") is not None
+        or conditions.get("logged_in") is not None
+        or conditions.get("rollout_percent") is not None
+    ):
+        headers.add("Cookie")
+    return headers
+
+
+def compile_conditions(conditions: Mapping[str, Any]) -> Tuple[Predicate, ...]:
+    """
+    Compile rule conditions into predicates, cheapest checks first.
+
+    Args:
+        conditions: Conditions as returned by AudienceRule.get_conditions
+
+    Returns:
+        Tuple of predicates that all have to match for the rule to apply
+    """
+    predicates: List[Predicate] = []
+
+    path_prefix = conditions.get("path_prefix")
+    if path_prefix is not None:
+        predicates.append(lambda request: request.path.startswith(path_prefix))
+
+    header = conditions.get("header")
+    if header is not None:
+        predicates.append(
+            _value_predicate(
+                lambda request: request.headers.get(header),
+                conditions.get("header_pattern"),
+            )
+        )
+
+    cookie = conditions.get("cookie")
+    if cookie is not None:
+        predicates.append(
+            _value_predicate(
+                lambda request: request.cookies.get(cookie),
+                conditions.get("cookie_pattern"),
+            )
+        )
+
+    logged_in = conditions.get("logged_in")
+    if logged_in is not None:
+        session_key = conditions.get("session_key", "user")
+        predicates.append(lambda request: (session_key in session) == logged_in)
+
+    rollout_percent = conditions.get("rollout_percent")
+    if rollout_percent is not None:
+        threshold = round(rollout_percent * ROLLOUT_BUCKETS / 100)
+        rollout_cookie = conditions.get("rollout_cookie")
+        salt = conditions.get("rollout_salt", "")
+
+        def in_rollout(request: Request) -> bool:
+            # Visitors without the cookie are not part of the rollout
+            key = request.cookies.get(rollout_cookie) if rollout_cookie else None
+            return key is not None and rollout_bucket(key, salt) < threshold
+
+        predicates.append(in_rollout)
+
+    return tuple(predicates)
+
+
+class TargetingMetrics:
+    """
+    Counters of rule evaluation, exposed for monitoring.
+
+    Attributes:
+        evaluations: Number of requests the rules were evaluated for
+        total_ns: Total time spent evaluating rules, in nanoseconds
+        rule_hits: Number of requests matched by each rule, in rule order
+        default_hits: Number of requests that matched no rule
+    """
+
+    def __init__(self, rule_count: int):
+        self.evaluations = 0
+        self.total_ns = 0
+        self.rule_hits = [0] * rule_count
+        self.default_hits = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get a snapshot of the metrics, including the mean evaluation time."""
+        return {
+            "evaluations": self.evaluations,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns / self.evaluations if self.evaluations else 0.0,
+            "rule_hits": list(self.rule_hits),
+            "default_hits": self.default_hits,
+        }
+
+
+class AudienceMatcher:
+    """
+    Ordered decision list picking the prerendered bar for a request.
+
+    Each entry is a tuple of precompiled predicates and the bar to show
+    (None to show no bar). The first entry whose predicates all match wins;
+    requests matching no entry get the default bar.
+    """
+
+    def __init__(
+        self,
+        default: Optional[RenderedBar],
+        rules: Sequence[Tuple[Mapping[str, Any], Optional[RenderedBar]]] = (),
+        bar_id: str = "MsgBar",
+    ):
+        """
+        Compile the rules into the matcher.
+
+        Args:
+            default: Bar for requests matching no rule (None to show no bar)
+            rules: Ordered pairs of rule conditions and the bar to show
+            bar_id: HTML id of the bars
+        """
+        self.bar_id = bar_id
+        self.default = default
+        self.rules = tuple(
+            (compile_conditions(conditions), bar) for conditions, bar in rules
+        )
+        self.metrics = TargetingMetrics(len(self.rules))
+        # Headers that the selection depends on, to be listed in the Vary header
+        self.vary: FrozenSet[str] = frozenset(
+            header for conditions, _ in rules for header in get_vary_headers(conditions)
+        )
+
+    @classmethod
+    def from_payload(cls, payload: Mapping[str, Any]) -> "AudienceMatcher":
+        """
+        Build a matcher from a payload created by ``render.build_payload``.
+
+        Raises:
+            ValueError: If the payload is malformed
+        """
+        if not isinstance(payload, Mapping):
+            raise ValueError("Invalid msgbar payload: not an object")
+        try:
+            default = payload["default"]
+            rules = []
+            for rule in payload["rules"]:
+                conditions = rule["conditions"]
+                if not isinstance(conditions, Mapping):
+                    raise ValueError(
+                        f"Invalid msgbar payload: rule conditions {conditions!r} "
+                        "are not an object"
+                    )
+                bar = (
+                    None if rule["bar"] is None else RenderedBar.from_json(rule["bar"])
+                )
+                rules.append((conditions, bar))
+            # Compiling the conditions can fail on corrupt patterns or values
+            return cls(
+                None if default is None else RenderedBar.from_json(default),
+                rules,
+                payload["bar_id"],
+            )
+        except (KeyError, TypeError, re.error) as e:
+            raise ValueError(f"Invalid msgbar payload: {e}") from e
+
+    @property
+    def matcher(self) -> "AudienceMatcher":
+        """The matcher itself, so that it can be registered as a bar source."""
+        return self
+
+    def select(self, request: Request) -> Optional[RenderedBar]:
+        """
+        Select the bar to show for a request.
+
+        Args:
+            request: The current Flask request
+
+        Returns:
+            The prerendered bar, or None if no bar should be shown
+        """
+        metrics = self.metrics
+        start = time.perf_counter_ns()
+        selected = self.default
+        for index, (predicates, bar) in enumerate(self.rules):
+            if all(predicate(request) for predicate in predicates):
+                metrics.rule_hits[index] += 1
+                selected = bar
+                break
+        else:
+            metrics.default_hits += 1
+        metrics.evaluations += 1
+        metrics.total_ns += time.perf_counter_ns() - start
+        return selected
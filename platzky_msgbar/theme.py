@@ -0,0 +1,12 @@
+"""Platzky theme defaults used as styling fallbacks of the message bar."""
+
+from platzky import Engine
+
+
+def get_theme(app: Engine) -> dict:
+    """Get the Platzky theme defaults used as styling fallbacks from the database."""
+    return {
+        "primary_color": app.db.get_primary_color(),
+        "secondary_color": app.db.get_secondary_color(),
+        "font": app.db.get_font(),
+    }
@@ -1,5 +1,5 @@
 import re
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 from platzky.platzky import create_app_from_config, Config
 from flask import Flask
 
@@ -269,8 +269,9 @@ def test_msgbar_sanitizes_event_handlers():
     # The malicious onclick should not appear in the message link
     # No inline onclick handlers are allowed inside message content
     assert "onclick" not in msgbar_content
-    # But the close button's onclick (outside msg-content) should still exist
-    assert 'onclick="document.getElementById' in html
+    # The close button is wired up by a script instead of an inline handler
+    assert "onclick" not in html
+    assert "addEventListener('click'" in html
     assert "alert('XSS')" not in msgbar_content
     # The safe parts should still be present in the message content
     assert '<a href="https://example.com"' in msgbar_content
@@ -418,3 +419,722 @@ def test_msgbar_requires_message_field():
     # Verify the error is about the missing 'message' field
     assert "message" in str(exc_info.value).lower()
     assert "field required" in str(exc_info.value).lower()
+
+
+def test_msgbar_close_handler_is_not_inline():
+    """Test that the close button uses a script instead of an inline onclick (CSP)"""
+    app = _create_app_with_plugin({"message": "Test"})
+    html = _get_response_html(app)
+
+    assert '<button class="close-btn" type="button">&times;</button>' in html
+    assert "onclick" not in html
+    assert "<script>" in html
+    assert "nonce=" not in html
+
+
+def test_msgbar_uses_csp_nonce_from_request():
+    """Test that the per-request CSP nonce is added to the inline style and script"""
+    from flask import g
+
+    app = _create_app_with_plugin({"message": "Test"})
+    nonces = iter(["first-nonce", "second-nonce"])
+
+    @app.before_request
+    def set_nonce():
+        g.csp_nonce = next(nonces)
+
+    first = _get_response_html(app)
+    second = _get_response_html(app)
+
+    assert '<style id="MsgBarStyle" nonce="first-nonce">' in first
+    assert '<script nonce="first-nonce">' in first
+    assert '<style id="MsgBarStyle" nonce="second-nonce">' in second
+    assert '<script nonce="second-nonce">' in second
+    assert "first-nonce" not in second
+
+
+def test_msgbar_escapes_csp_nonce():
+    """Test that a nonce cannot break out of its attribute"""
+    from flask import g
+
+    app = _create_app_with_plugin({"message": "Test"})
+
+    @app.before_request
+    def set_nonce():
+        g.csp_nonce = '"><script>alert(1)</script>'
+
+    html = _get_response_html(app)
+
+    assert "<script>alert(1)</script>" not in html
+    assert 'nonce="&#34;&gt;&lt;script&gt;' in html
+
+
+def test_msgbar_fills_message_variables_per_request():
+    """Test that {{ name }} placeholders are filled from g.msgbar_vars and escaped"""
+    from flask import g
+
+    app = _create_app_with_plugin({"message": "Hello **{{ user }}**, welcome!"})
+    users = iter(["Alice", "<b>Bob</b>"])
+
+    @app.before_request
+    def set_user():
+        g.msgbar_vars = {"user": next(users)}
+
+    first = _extract_msgbar_content(_get_response_html(app))
+    second = _extract_msgbar_content(_get_response_html(app))
+
+    assert first == "Hello <strong>Alice</strong>, welcome!"
+    assert second == "Hello <strong>&lt;b&gt;Bob&lt;/b&gt;</strong>, welcome!"
+
+
+def test_msgbar_renders_missing_message_variables_empty():
+    """Test that placeholders without a value render as empty text"""
+    app = _create_app_with_plugin({"message": "Hello {{ user }}!"})
+    html = _get_response_html(app)
+
+    assert _extract_msgbar_content(html) == "Hello !"
+
+
+def test_msgbar_rules_pick_bar_by_header_and_cookie():
+    """Test that the first matching audience rule picks the bar to show"""
+    app = _create_app_with_plugin(
+        {
+            "message": "Default bar",
+            "rules": [
+                {"header": "X-Beta", "bar": {"message": "Beta bar"}},
+                {
+                    "cookie": "plan",
+                    "cookie_pattern": "^pro$",
+                    "bar": {"message": "Pro bar", "background_color": "#000000"},
+                },
+            ],
+        }
+    )
+    client = app.test_client()
+
+    html = client.get("/page/test").data.decode()
+    assert _extract_msgbar_content(html) == "Default bar"
+
+    html = client.get("/page/test", headers={"X-Beta": "1"}).data.decode()
+    assert _extract_msgbar_content(html) == "Beta bar"
+
+    client.set_cookie("plan", "pro")
+    html = client.get("/page/test", headers={"X-Beta": "1"}).data.decode()
+    assert _extract_msgbar_content(html) == "Beta bar"  # first match wins
+    html = client.get("/page/test").data.decode()
+    assert _extract_msgbar_content(html) == "Pro bar"
+    assert "background-color: #000000" in _extract_msgbar_style(html)
+
+    client.set_cookie("plan", "professional")
+    html = client.get("/page/test").data.decode()
+    assert _extract_msgbar_content(html) == "Default bar"
+
+
+def test_msgbar_rules_match_logged_in_and_path_prefix():
+    """Test logged-in and path prefix conditions, and hiding the bar"""
+    app = _create_app_with_plugin(
+        {
+            "message": "Please log in",
+            "rules": [
+                {"path_prefix": "/blog", "bar": {"message": "Blog bar"}},
+                {"logged_in": True, "path_prefix": "/page", "bar": {"message": "Hi!"}},
+                {"header": "X-Hide", "hide": True},
+            ],
+        }
+    )
+    client = app.test_client()
+
+    html = client.get("/page/test").data.decode()
+    assert _extract_msgbar_content(html) == "Please log in"
+
+    html = client.get("/page/test", headers={"X-Hide": "1"}).data.decode()
+    assert "<head>" in html
+    assert "MsgBar" not in html
+
+    with client.session_transaction() as sess:
+        sess["user"] = "alice"
+    html = client.get("/page/test", headers={"X-Hide": "1"}).data.decode()
+    assert _extract_msgbar_content(html) == "Hi!"
+
+
+def test_msgbar_rules_rollout_percentage():
+    """Test that rollout buckets are stable and respect the percentage"""
+    from platzky_msgbar.targeting import ROLLOUT_BUCKETS, rollout_bucket
+
+    assert rollout_bucket("visitor") == rollout_bucket("visitor")
+    assert 0 <= rollout_bucket("visitor", "salt") < ROLLOUT_BUCKETS
+
+    app = _create_app_with_plugin(
+        {
+            "message": "Old",
+            "rules": [
+                {
+                    "rollout_percent": 0,
+                    "rollout_cookie": "uid",
+                    "bar": {"message": "Nobody"},
+                },
+                {
+                    "rollout_percent": 100,
+                    "rollout_cookie": "uid",
+                    "bar": {"message": "Everybody"},
+                },
+            ],
+        }
+    )
+    client = app.test_client()
+    html = client.get("/page/test").data.decode()
+    assert _extract_msgbar_content(html) == "Old"  # no cookie, not in rollout
+    client.set_cookie("uid", "visitor-1")
+    html = client.get("/page/test").data.decode()
+    assert _extract_msgbar_content(html) == "Everybody"
+
+
+def test_msgbar_rules_partial_rollout_is_stable_per_cookie():
+    """Test that a partial rollout splits visitors by cookie and keeps them in place"""
+    from platzky_msgbar.targeting import ROLLOUT_BUCKETS, rollout_bucket
+
+    app = _create_app_with_plugin(
+        {
+            "message": "Old",
+            "rules": [
+                {
+                    "rollout_percent": 25,
+                    "rollout_cookie": "uid",
+                    "rollout_salt": "editor",
+                    "bar": {"message": "New"},
+                }
+            ],
+        }
+    )
+    in_rollout = 0
+    for visitor in range(200):
+        uid = f"visitor-{visitor}"
+        expected = rollout_bucket(uid, "editor") < ROLLOUT_BUCKETS // 4
+        client = app.test_client()
+        client.set_cookie("uid", uid)
+        for _ in range(2):
+            html = client.get("/page/test").data.decode()
+            assert (_extract_msgbar_content(html) == "New") == expected
+        in_rollout += expected
+
+    assert 30 <= in_rollout <= 70
+
+
+def test_msgbar_rules_rollout_requires_cookie():
+    """Test that percentage rollouts must be bucketed by a cookie"""
+    import pytest
+    from platzky.plugin_loader import PluginError
+
+    with pytest.raises(PluginError) as exc_info:
+        _create_app_with_plugin({"message": "Test", "rules": [{"rollout_percent": 50}]})
+
+    assert "rollout_cookie" in str(exc_info.value)
+
+
+def test_msgbar_rules_reject_invalid_pattern():
+    """Test that an invalid rule regex fails plugin loading instead of being ignored"""
+    import pytest
+    from platzky.plugin_loader import PluginError
+
+    with pytest.raises(PluginError) as exc_info:
+        _create_app_with_plugin(
+            {"message": "Test", "rules": [{"header": "X-A", "header_pattern": "("}]}
+        )
+
+    assert "invalid pattern" in str(exc_info.value).lower()
+
+
+def test_msgbar_rules_reject_unknown_keys():
+    """Test that misspelled rule conditions and bar overrides fail plugin loading"""
+    import pytest
+    from platzky.plugin_loader import PluginError
+
+    with pytest.raises(PluginError) as exc_info:
+        _create_app_with_plugin(
+            {"message": "Test", "rules": [{"path": "/admin", "hide": True}]}
+        )
+    assert "path" in str(exc_info.value)
+
+    with pytest.raises(PluginError) as exc_info:
+        _create_app_with_plugin(
+            {"message": "Test", "rules": [{"header": "X-A", "bar": {"mesage": "B"}}]}
+        )
+    assert "mesage" in str(exc_info.value)
+
+
+def test_msgbar_rules_expose_metrics():
+    """Test that rule evaluation counters are exposed on the app"""
+    app = _create_app_with_plugin(
+        {"message": "Default", "rules": [{"header": "X-Beta", "hide": True}]}
+    )
+    client = app.test_client()
+    client.get("/page/test")
+    client.get("/page/test", headers={"X-Beta": "1"})
+    client.get("/page/test", headers={"X-Beta": "1"})
+
+    metrics = app.extensions["msgbar"]["MsgBar"].metrics.as_dict()
+    assert metrics["evaluations"] == 3
+    assert metrics["rule_hits"] == [2]
+    assert metrics["default_hits"] == 1
+    assert metrics["total_ns"] > 0
+    assert metrics["mean_ns"] == metrics["total_ns"] / 3
+
+
+def test_msgbar_shared_state_updates_all_workers(tmp_path):
+    """Test that a published config reaches every app sharing the state file"""
+    import json
+
+    state_path = str(tmp_path / "msgbar.json")
+    plugin_config = {"message": "Initial", "shared_state_path": state_path}
+    worker_a = _create_app_with_plugin(plugin_config)
+    worker_b = _create_app_with_plugin(plugin_config)
+
+    assert _extract_msgbar_content(_get_response_html(worker_a)) == "Initial"
+    assert _extract_msgbar_content(_get_response_html(worker_b)) == "Initial"
+    assert worker_a.extensions["msgbar"]["MsgBar"].version == 1
+
+    config_file = tmp_path / "update.json"
+    config_file.write_text(json.dumps({"message": "Updated **now**"}))
+    result = worker_a.test_cli_runner().invoke(
+        args=["msgbar", "publish", str(config_file)]
+    )
+    assert result.exit_code == 0, result.output
+    assert "version 2" in result.output
+
+    assert _extract_msgbar_content(_get_response_html(worker_a)) == (
+        "Updated <strong>now</strong>"
+    )
+    assert _extract_msgbar_content(_get_response_html(worker_b)) == (
+        "Updated <strong>now</strong>"
+    )
+
+    # A restarted worker keeps serving the published bar instead of its config
+    worker_c = _create_app_with_plugin(plugin_config)
+    assert _extract_msgbar_content(_get_response_html(worker_c)) == (
+        "Updated <strong>now</strong>"
+    )
+
+
+def test_msgbar_shared_state_is_read_once_per_request(tmp_path, monkeypatch):
+    """Test that a request reads the shared version once for its bar and Vary"""
+    from platzky_msgbar.shared import SharedBarState
+
+    state_path = str(tmp_path / "msgbar.json")
+    app = _create_app_with_plugin(
+        {
+            "message": "Default",
+            "shared_state_path": state_path,
+            "rules": [{"header": "X-Beta", "bar": {"message": "Beta"}}],
+        }
+    )
+    reads = []
+    version = SharedBarState.version
+    monkeypatch.setattr(
+        SharedBarState,
+        "version",
+        property(lambda self: reads.append(1) or version.fget(self)),
+    )
+
+    response = app.test_client().get("/page/test", headers={"X-Beta": "1"})
+    assert "X-Beta" in response.vary
+    assert _extract_msgbar_content(response.data.decode()) == "Beta"
+    assert len(reads) == 1
+
+
+def test_msgbar_shared_state_publish_rejects_invalid_config(tmp_path):
+    """Test that an invalid config is not published"""
+    import json
+
+    state_path = str(tmp_path / "msgbar.json")
+    app = _create_app_with_plugin(
+        {"message": "Initial", "shared_state_path": state_path}
+    )
+
+    config_file = tmp_path / "update.json"
+    config_file.write_text(json.dumps({"text_color": "red"}))
+    result = app.test_cli_runner().invoke(args=["msgbar", "publish", str(config_file)])
+
+    assert result.exit_code != 0
+    assert app.extensions["msgbar"]["MsgBar"].version == 1
+    assert _extract_msgbar_content(_get_response_html(app)) == "Initial"
+
+
+def test_msgbar_stacks_bars_with_unique_ids_in_one_hook():
+    """Test that bars with different ids are stacked and injected by a single hook"""
+    from platzky_msgbar import process
+
+    app = _create_app_with_plugin({"message": "Site notice", "bar_height": "40px"})
+    hook_count = len(app.after_request_funcs[None])
+
+    process(app, {"message": "Section notice", "bar_id": "SectionBar"})
+    assert len(app.after_request_funcs[None]) == hook_count
+
+    html = _get_response_html(app)
+    assert html.count('id="MsgBar"') == 1
+    assert html.count('id="SectionBar"') == 1
+    assert html.index('id="MsgBar"') < html.index('id="SectionBar"')
+    assert html.count("</head>") == 1
+
+    style = _extract_msgbar_style(html)
+    assert "top: 0;" in style
+    # The bar is exactly as tall as the offset given to the bar below it
+    assert "height: 40px;" in style
+    assert "box-sizing: border-box;" in style
+    assert "overflow: hidden;" in style
+    assert "padding-top: 40px !important" in style
+    match = re.search(r'<style id="SectionBarStyle">(.*?)</style>', html, re.DOTALL)
+    assert match is not None
+    assert "#SectionBar {" in match.group(1)
+    assert "top: 40px;" in match.group(1)
+    assert "height: 30px;" in match.group(1)
+    assert "padding-top: calc(40px + 30px) !important" in match.group(1)
+    assert "getElementById('SectionBarStyle')" in html
+    # Closing a bar moves the remaining bars up and shrinks the body padding
+    assert html.count("data-msgbar>") == 2
+    assert "querySelectorAll('[data-msgbar]')" in html
+    assert "setProperty('padding-top', top + 'px', 'important')" in html
+
+    # A bar on its own grows with its message instead of being clipped
+    single_style = _extract_msgbar_style(
+        _get_response_html(_create_app_with_plugin({"message": "Site notice"}))
+    )
+    assert "height:" not in single_style
+    assert "overflow: hidden;" not in single_style
+    assert "padding-top: 30px !important" in single_style
+
+
+def test_msgbar_process_again_updates_bar():
+    """Test that calling process again with the same bar id replaces the bar"""
+    from platzky_msgbar import process
+
+    app = _create_app_with_plugin({"message": "Old notice"})
+    hook_count = len(app.after_request_funcs[None])
+
+    process(app, {"message": "New notice"})
+
+    assert len(app.after_request_funcs[None]) == hook_count
+    assert list(app.extensions["msgbar"]) == ["MsgBar"]
+    html = _get_response_html(app)
+    assert html.count('id="MsgBar"') == 1
+    assert _extract_msgbar_content(html) == "New notice"
+
+
+def test_msgbar_stacking_skips_hidden_bars():
+    """Test that a bar hidden by its rules does not leave a gap in the stack"""
+    from platzky_msgbar import process
+
+    app = _create_app_with_plugin(
+        {"message": "Site notice", "rules": [{"header": "X-Hide", "hide": True}]}
+    )
+    process(app, {"message": "Section notice", "bar_id": "SectionBar"})
+
+    html = app.test_client().get("/page/test", headers={"X-Hide": "1"}).data.decode()
+    assert 'id="MsgBar"' not in html
+    match = re.search(r'<style id="SectionBarStyle">(.*?)</style>', html, re.DOTALL)
+    assert match is not None
+    assert "top: 0;" in match.group(1)
+    assert "padding-top: 30px !important" in match.group(1)
+
+
+def test_msgbar_rejects_invalid_bar_id():
+    """Test that bar ids that are not safe HTML ids are rejected"""
+    import pytest
+    from platzky.plugin_loader import PluginError
+
+    with pytest.raises(PluginError):
+        _create_app_with_plugin({"message": "Test", "bar_id": "x'); alert(1); ('"})
+
+
+def _build_artifact(tmp_path, plugin_config: Dict[str, Any], *args: str):
+    """Build an artifact for a plugin config with the platzky-msgbar CLI"""
+    import json
+    from click.testing import CliRunner
+    from platzky_msgbar.cli import main
+
+    config_file = tmp_path / "msgbar_config.json"
+    config_file.write_text(json.dumps(plugin_config))
+    artifact_file = tmp_path / "msgbar_artifact.json"
+    result = CliRunner().invoke(
+        main, ["build", str(config_file), "-o", str(artifact_file), *args]
+    )
+    assert result.exit_code == 0, result.output
+    return config_file, artifact_file
+
+
+def test_msgbar_loads_prebuilt_artifact(tmp_path):
+    """Test that a bar built ahead of time is served from its artifact"""
+    _, artifact_file = _build_artifact(
+        tmp_path,
+        {
+            "message": "Prebuilt [bar](https://example.com)",
+            "rules": [{"header": "X-Beta", "bar": {"message": "Beta"}}],
+        },
+        "--primary-color",
+        "#123456",
+    )
+    app = _create_app_with_plugin({"artifact": str(artifact_file)})
+    html = _get_response_html(app)
+
+    assert _extract_msgbar_content(html) == (
+        'Prebuilt <a href="https://example.com">bar</a>'
+    )
+    assert "background-color: #123456" in _extract_msgbar_style(html)
+    html = app.test_client().get("/page/test", headers={"X-Beta": "1"}).data.decode()
+    assert _extract_msgbar_content(html) == "Beta"
+
+
+def test_msgbar_artifact_check_detects_stale_and_tampered_artifacts(tmp_path):
+    """Test that the check command validates artifacts against their config"""
+    import json
+    from click.testing import CliRunner
+    from platzky_msgbar.cli import main
+
+    config_file, artifact_file = _build_artifact(tmp_path, {"message": "Hello"})
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["check", str(config_file), str(artifact_file)])
+    assert result.exit_code == 0, result.output
+
+    config_file.write_text(json.dumps({"message": "Changed"}))
+    result = runner.invoke(main, ["check", str(config_file), str(artifact_file)])
+    assert result.exit_code != 0
+    assert "out of date" in result.output
+
+    artifact_file.write_text(artifact_file.read_text().replace("Hello", "Hacked"))
+    result = runner.invoke(main, ["check", str(config_file), str(artifact_file)])
+    assert result.exit_code != 0
+    assert "sha256 does not match" in result.output
+
+
+def test_msgbar_build_rejects_unusable_configs(tmp_path):
+    """Test that build reports configs it cannot turn into an artifact"""
+    import json
+    from click.testing import CliRunner
+    from platzky_msgbar.cli import main
+
+    config_file = tmp_path / "msgbar_config.json"
+    configs = {
+        "expected a JSON object": ["message"],
+        "shared_state_path cannot be used": {
+            "message": "Hello",
+            "shared_state_path": str(tmp_path / "state.json"),
+        },
+        "mesage": {"message": "Hi", "rules": [{"header": "X", "bar": {"mesage": "B"}}]},
+    }
+    for error, config in configs.items():
+        config_file.write_text(json.dumps(config))
+        result = CliRunner().invoke(main, ["build", str(config_file)])
+        assert result.exit_code == 1, result.output
+        assert isinstance(result.exception, SystemExit)
+        assert error in result.output
+
+
+def test_msgbar_rejects_tampered_artifact(tmp_path):
+    """Test that plugin loading fails for an artifact that does not match its hash"""
+    import pytest
+    from platzky.plugin_loader import PluginError
+
+    _, artifact_file = _build_artifact(tmp_path, {"message": "Hello"})
+    artifact_file.write_text(artifact_file.read_text().replace("Hello", "Hacked"))
+
+    with pytest.raises(PluginError) as exc_info:
+        _create_app_with_plugin({"artifact": str(artifact_file)})
+
+    assert "sha256" in str(exc_info.value)
+
+
+def _get_imported_modules(plugin_config: Dict[str, Any], modules: List[str]):
+    """Load the plugin in a fresh interpreter and return which modules it imported"""
+    import os
+    import subprocess
+    import sys
+
+    script = (
+        "import sys\n"
+        "from test_msgbar import _create_app_with_plugin, _get_response_html\n"
+        f"app = _create_app_with_plugin({plugin_config!r})\n"
+        "assert 'MsgBar' in _get_response_html(app)\n"
+        f"print(','.join(name for name in {modules!r} if name in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join([os.path.dirname(__file__), *sys.path]),
+        },
+    )
+    imported = result.stdout.strip().splitlines()[-1:]
+    return [name for name in "".join(imported).split(",") if name]
+
+
+def test_msgbar_artifact_skips_render_pipeline_imports(tmp_path):
+    """Test that loading an artifact does not import Markdown, bleach or the config model"""
+    _, artifact_file = _build_artifact(tmp_path, {"message": "Hello"})
+    heavy = ["markdown", "bleach", "platzky_msgbar.render", "platzky_msgbar.config"]
+
+    assert _get_imported_modules({"artifact": str(artifact_file)}, heavy) == []
+
+
+def test_msgbar_does_not_import_shared_state_when_unused():
+    """Test that the POSIX-only shared state module is only imported in shared mode"""
+    assert _get_imported_modules({"message": "Hello"}, ["platzky_msgbar.shared"]) == []
+
+
+def test_msgbar_rejects_message_variables_in_link_urls():
+    """Test that placeholders cannot be used where escaping does not prevent XSS"""
+    import pytest
+    from platzky.plugin_loader import PluginError
+
+    with pytest.raises(PluginError) as exc_info:
+        _create_app_with_plugin({"message": "[profile]({{ link }})"})
+    assert "only allowed in text" in str(exc_info.value)
+
+    with pytest.raises(PluginError):
+        _create_app_with_plugin({"message": '[a](https://example.com "{{ title }}")'})
+
+
+def test_msgbar_allows_message_variables_in_link_text():
+    """Test that placeholders in link text are filled in and escaped"""
+    from flask import g
+
+    app = _create_app_with_plugin({"message": "[Hi {{ user }}](https://example.com)"})
+
+    @app.before_request
+    def set_user():
+        g.msgbar_vars = {"user": "<script>x</script>"}
+
+    html = _get_response_html(app)
+    assert _extract_msgbar_content(html) == (
+        '<a href="https://example.com">Hi &lt;script&gt;x&lt;/script&gt;</a>'
+    )
+
+
+def test_msgbar_rules_set_vary_header():
+    """Test that responses vary on the headers and cookies audience rules read"""
+    app = _create_app_with_plugin(
+        {
+            "message": "Default",
+            "rules": [
+                {"header": "X-Beta", "bar": {"message": "Beta"}},
+                {"cookie": "plan", "bar": {"message": "Pro"}},
+            ],
+        }
+    )
+    response = app.test_client().get("/page/test")
+    assert "X-Beta" in response.vary
+    assert "Cookie" in response.vary
+
+    plain_app = _create_app_with_plugin({"message": "Default"})
+    response = plain_app.test_client().get("/page/test")
+    assert "X-Beta" not in response.vary
+
+
+def test_msgbar_shared_state_survives_unreadable_state(tmp_path, caplog):
+    """Test that a broken state file keeps the last good bar instead of failing pages"""
+    import json
+    import os
+    import struct
+
+    state_path = str(tmp_path / "msgbar.json")
+    app = _create_app_with_plugin({"message": "Good", "shared_state_path": state_path})
+    state = app.extensions["msgbar"]["MsgBar"]
+    assert _extract_msgbar_content(_get_response_html(app)) == "Good"
+
+    # A corrupt payload is logged once and the last good bar is kept
+    state.publish({"not": "a payload"})
+    loads = []
+    original_load = state._load
+    state._load = lambda: loads.append(1) or original_load()
+    for _ in range(3):
+        assert _extract_msgbar_content(_get_response_html(app)) == "Good"
+    assert len(loads) == 1
+    assert "Could not load message bar state" in caplog.text
+
+    # Structurally broken payloads and states are rejected the same way
+    broken_rules = [
+        [{"conditions": ["header", "X-A"], "bar": None}],
+        [{"conditions": {"header": "X-A", "header_pattern": "("}, "bar": None}],
+    ]
+    for rules in broken_rules:
+        state.publish({"bar_id": "MsgBar", "default": None, "rules": rules})
+        assert _extract_msgbar_content(_get_response_html(app)) == "Good"
+    with open(state_path, "w") as f:
+        json.dump({"format": 1}, f)
+    struct.pack_into("<Q", state._version_map, 0, state.version + 1)
+    assert _extract_msgbar_content(_get_response_html(app)) == "Good"
+    assert caplog.text.count("Could not load message bar state") == 4
+
+    # A missing state file in a fresh worker shows no bar instead of a 500
+    fresh = _create_app_with_plugin(
+        {"message": "Good", "shared_state_path": state_path}
+    )
+    os.remove(state_path)
+    html = _get_response_html(fresh)
+    assert "MsgBar" not in html
+
+
+def test_msgbar_shared_state_reseeds_incompatible_format(tmp_path, caplog):
+    """Test that a state file in an old format is replaced instead of breaking pages"""
+    import json
+
+    state_file = tmp_path / "msgbar.json"
+    # Unversioned payload, as written before the state format was introduced
+    state_file.write_text(json.dumps({"default": ["old"], "rules": []}))
+
+    app = _create_app_with_plugin(
+        {"message": "Reseeded", "shared_state_path": str(state_file)}
+    )
+
+    assert "old format" in caplog.text
+    assert json.loads(state_file.read_text())["format"] == 1
+    assert _extract_msgbar_content(_get_response_html(app)) == "Reseeded"
+
+
+def test_msgbar_shared_state_does_not_render_existing_state(tmp_path, caplog):
+    """Test that workers only render when seeding and warn about config changes"""
+    from unittest import mock
+    import platzky_msgbar.render
+
+    state_path = str(tmp_path / "msgbar.json")
+    _create_app_with_plugin({"message": "First", "shared_state_path": state_path})
+
+    with mock.patch.object(
+        platzky_msgbar.render,
+        "build_payload",
+        wraps=platzky_msgbar.render.build_payload,
+    ) as build_payload:
+        _create_app_with_plugin({"message": "First", "shared_state_path": state_path})
+        assert build_payload.call_count == 0
+        assert "differs" not in caplog.text
+
+        app = _create_app_with_plugin(
+            {"message": "Second", "shared_state_path": state_path}
+        )
+        assert build_payload.call_count == 0
+
+    assert "differs from the bar published" in caplog.text
+    assert _extract_msgbar_content(_get_response_html(app)) == "First"
+
+
+def test_msgbar_write_artifact_leaves_no_temporary_file_on_error(tmp_path):
+    """Test that a failed artifact write cleans up and keeps the previous artifact"""
+    import os
+    import pytest
+    from unittest import mock
+    from platzky_msgbar.artifact import load_artifact, write_artifact
+
+    path = str(tmp_path / "msgbar_artifact.json")
+    payload = {"bar_id": "MsgBar", "default": None, "rules": []}
+    with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+        write_artifact(path, payload)
+    assert fsync.called
+
+    with mock.patch("os.replace", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            write_artifact(path, {**payload, "bar_id": "Other"})
+
+    assert os.listdir(tmp_path) == ["msgbar_artifact.json"]
+    assert load_artifact(path) == payload